@@ -1,131 +1,297 @@
-from openai import OpenAI
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
+from stream_parser import FileStreamParser, completed_files
 import os
 import ast
+import copy
+import hashlib
+import logging
+import orjson
 import re
+import string
+from collections import OrderedDict
 load_dotenv()
 
+logger = logging.getLogger(__name__)
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") 
-client = OpenAI(base_url=OPENAI_BASE_URL,api_key=OPENAI_API_KEY)
+client = AsyncOpenAI(base_url=OPENAI_BASE_URL,api_key=OPENAI_API_KEY)
 
-def _execute_llm_call(prompt: str, model: str = "gpt-4o-mini") -> dict:
+# Pulls the outermost {...} block out of a free-form LLM reply.
+_DICT_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+# Prompt budget for existing-file context in the modify flow. Estimated at ~4 characters per token.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "20000"))
+_CHARS_PER_TOKEN = 4
+# When over budget, the largest files are cut down to this much head and tail, plus an outline.
+EXCERPT_EDGE = 1024
+# Top-level definitions worth keeping in an excerpt's outline (JS/TS functions and classes, Python defs).
+_SIGNATURE_RE = re.compile(
+    r'^[ \t]*(?:export\s+)?(?:default\s+)?(?:async\s+)?(?:function\b.*|class\s+\w+.*|def\s+\w+.*|(?:const|let|var)\s+\w+\s*=\s*(?:async\s*)?\(.*)$',
+    re.MULTILINE
+)
+
+# Exact-match response cache, keyed by a hash of the model and prompt. Enable with LLM_CACHE=1.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE") == "1"
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "512"))
+llm_cache_stats = {"hits": 0, "misses": 0}
+_llm_cache = OrderedDict()
+
+def _llm_cache_key(prompt: str, model: str) -> str:
+    return hashlib.sha256(f"{model}\n{prompt}".encode("utf-8")).hexdigest()
+
+def _llm_cache_get(key: str):
+    """Returns a copy of the cached parsed response, or None on a miss."""
+    files = _llm_cache.get(key)
+    if files is None:
+        llm_cache_stats["misses"] += 1
+        return None
+    _llm_cache.move_to_end(key)
+    llm_cache_stats["hits"] += 1
+    # Callers add attachments to the returned dict, so never hand out the cached object itself.
+    return copy.deepcopy(files)
+
+def _llm_cache_put(key: str, files: dict):
+    _llm_cache[key] = copy.deepcopy(files)
+    _llm_cache.move_to_end(key)
+    while len(_llm_cache) > LLM_CACHE_SIZE:
+        _llm_cache.popitem(last=False)
+
+async def _execute_llm_call(prompt: str, model: str = "gpt-4o-mini", on_file=None, files_key: str = None) -> dict:
     """
-    Executes a call to the LLM, handles potential API errors, and robustly
-    parses the response to extract a Python dictionary.
+    Executes a call to the LLM, handles potential API errors, and parses the
+    response to extract a dictionary. The model is constrained to emit a JSON object.
+    The response is streamed; if on_file is given it is called with (path, content)
+    for each file as soon as it is complete, before the rest of the reply arrives.
+    Successfully parsed responses are cached when LLM_CACHE is enabled.
     """
+    cache_key = None
+    if LLM_CACHE_ENABLED:
+        cache_key = _llm_cache_key(prompt, model)
+        cached = _llm_cache_get(cache_key)
+        if cached is not None:
+            logger.info("LLM cache hit (%d hits, %d misses)", llm_cache_stats["hits"], llm_cache_stats["misses"])
+            if on_file:
+                # Replay exactly what the live stream would have reported.
+                for path, file_content in completed_files(cached, files_key):
+                    on_file(path, file_content)
+            return cached
+
     try:
-        response = client.chat.completions.create(
+        stream = await client.chat.completions.create(
             model=model,
             messages=[{"role": "user", "content": prompt}],
             temperature=0.1,
+            response_format={"type": "json_object"},
+            stream=True,
         )
-        content = response.choices[0].message.content
-        print(f"LLM Response: {content}")
-
-        # Robust parsing: Find the dictionary within the response string
-        match = re.search(r'\{.*\}', content, re.DOTALL)
-        if not match:
-            print("Could not find a dictionary in the LLM response.")
-            # Fallback: return the raw content as the only file
-            return {"index.html": content}
+        parser = FileStreamParser(files_key) if on_file else None
+        parts = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            parts.append(delta)
+            if parser:
+                for path, file_content in parser.feed(delta):
+                    on_file(path, file_content)
+        content = "".join(parts)
+        logger.debug("LLM Response: %s", content)
 
-        dict_str = match.group(0)
         try:
-            # Use the safer ast.literal_eval to parse the dictionary string
-            files = ast.literal_eval(dict_str)
-            if isinstance(files, dict):
-                return files
-            else:
-                raise ValueError("Parsed content is not a dictionary.")
-        except (ValueError, SyntaxError) as e:
-            print(f"Could not parse LLM response as a dictionary: {e}")
+            files = orjson.loads(content)
+        except ValueError as e:
+            # JSON mode should make this rare; fall back to digging a dictionary out of the text.
+            logger.warning("Could not parse LLM response as JSON: %s", e)
+            match = _DICT_RE.search(content)
+            if not match:
+                logger.warning("Could not find a dictionary in the LLM response.")
+                # Fallback: return the raw content as the only file
+                return {"index.html": content}
+            files = _extract_dict(match.group(0))
+            if files is None:
+                return {"error.txt": f"Failed to parse LLM response.\n\nRaw Content:\n{content}"}
+
+        if not isinstance(files, dict):
+            logger.warning("Parsed LLM response is not a dictionary.")
             return {"error.txt": f"Failed to parse LLM response.\n\nRaw Content:\n{content}"}
 
+        if cache_key:
+            _llm_cache_put(cache_key, files)
+        return files
+
     except Exception as e:
-        print(f"An unexpected error occurred during LLM call: {e}")
+        logger.exception("An unexpected error occurred during LLM call: %s", e)
         return {
             "error.html": f"<html><body><h1>Failed to generate app via LLM</h1><pre>{e}</pre></body></html>"
         }
 
-def _llm_filter_relevant_files(brief: str, file_list: list) -> list:
+def _extract_dict(dict_str: str):
+    """Parses a dictionary literal cut out of free-form text. Returns None if it can't be parsed."""
+    try:
+        return orjson.loads(dict_str)
+    except ValueError:
+        pass
+    try:
+        # The model occasionally answers with a Python literal instead of JSON.
+        return ast.literal_eval(dict_str)
+    except (ValueError, SyntaxError) as e:
+        logger.warning("Could not parse LLM response as a dictionary: %s", e)
+        return None
+
+def _normalize_files(files: dict) -> dict:
     """
-    Uses an LLM call to intelligently select which files are relevant for a given change request.
+    Makes sure every file maps to string content. In JSON mode the model sometimes emits
+    a JSON file (e.g. manifest.json) as a nested object; those are serialized back to text.
     """
-    prompt = f"""
-As a senior software architect, your task is to identify which files need to be edited to fulfill a user's request.
-User's Request: "{brief}"
-Available Files: {file_list}
-
-Respond ONLY with a Python list of the full file paths that need to be modified.
-Example response: ['src/components/Header.vue', 'src/assets/style.css']
-"""
-    print("Asking LLM to identify relevant files...")
-    response_dict = _execute_llm_call(prompt)
-    
-    # The response is a dict, but the value we need is a list string. Let's find it.
-    for key, value in response_dict.items():
-        try:
-            # Assuming the response is a string representation of a list
-            relevant_files = ast.literal_eval(value)
-            if isinstance(relevant_files, list):
-                return relevant_files
-        except (ValueError, SyntaxError):
-            continue
-    
-    print("Warning: Could not parse relevant files list from LLM. Falling back to all files.")
-    return file_list # Fallback to all files if parsing fails
+    normalized = {}
+    for path, content in files.items():
+        if isinstance(content, str):
+            normalized[path] = content
+        elif isinstance(content, (dict, list)):
+            normalized[path] = orjson.dumps(content, option=orjson.OPT_INDENT_2).decode('utf-8')
+        else:
+            logger.warning("Dropping %s: LLM returned %s instead of file content", path, type(content).__name__)
+    return normalized
 
-def _generate_new_app(task_name: str, brief: str, checks: list, attachments: list) -> dict:
-    """Generates a new application from a brief, checks, and attachments."""
-    prompt = f"""
+_NEW_APP_PROMPT = string.Template("""
 As an expert software developer, create a complete, production-ready application.
 This application must work entirely as a static website.
-The official name for this task is '{task_name}'. Use this for titles or project names.
+The official name for this task is '${task_name}'. Use this for titles or project names.
 Your response must include a professional README.md  in file for the project.
 Do **not** include any LICENSE file or licensing text in this output.
 
-User Brief: "{brief}"
+User Brief: "${brief}"
 
 The following files are provided as attachments. Your code should be able to use them:
-{attachments}
+${attachments}
 
 Crucially, the code you generate must satisfy all of the following evaluation checks:
-{checks}
+${checks}
 
 Based on all the information, determine the required files (e.g., index.html, style.css, src/app.js, etc.).
-Respond ONLY with a single-line Python dictionary that maps full file paths to their complete string content.
+Respond ONLY with a JSON object that maps full file paths to their complete string content.
 Ensure all code is complete and does not contain placeholders.
-"""
-    return _execute_llm_call(prompt)
+""")
 
-def _modify_existing_app(task_name: str, brief: str, checks: list, attachments: list, existing_files: dict) -> dict:
-    """Modifies an existing application based on a brief, checks, attachments, and file context."""
-    prompt = f"""
-As an expert software developer, your task is to modify an existing project named '{task_name}'.
+async def _generate_new_app(task_name: str, brief: str, checks: list, attachments: list, on_file=None) -> dict:
+    """Generates a new application from a brief, checks, and attachments."""
+    prompt = _NEW_APP_PROMPT.substitute(task_name=task_name, brief=brief, attachments=attachments, checks=checks)
+    return _normalize_files(await _execute_llm_call(prompt, on_file=on_file))
+
+def _excerpt(text: str) -> str:
+    """Cuts a large file down to its head and tail plus an outline of the definitions in between."""
+    middle = text[EXCERPT_EDGE:-EXCERPT_EDGE]
+    outline = "\n".join(line.strip() for line in _SIGNATURE_RE.findall(middle))
+    omitted_lines = middle.count("\n")
+    return (
+        f"{text[:EXCERPT_EDGE]}\n[... excerpt: {omitted_lines} lines omitted; definitions in the omitted part:\n"
+        f"{outline}\n...]\n{text[-EXCERPT_EDGE:]}"
+    )
+
+def _build_file_context(existing_files: dict) -> tuple:
+    """
+    Fits the existing files into the prompt budget by excerpting the largest ones first.
+    Returns the context dict and the set of paths that were excerpted.
+    """
+    budget = CONTEXT_TOKEN_BUDGET * _CHARS_PER_TOKEN
+    total = sum(len(content) for content in existing_files.values())
+    context = dict(existing_files)
+    excerpted = set()
+    for path in sorted(existing_files, key=lambda p: len(existing_files[p]), reverse=True):
+        if total <= budget:
+            break
+        content = existing_files[path]
+        excerpt = _excerpt(content)
+        # Near 2 * EXCERPT_EDGE the excerpt is no shorter than the file; keep it whole and editable.
+        if len(excerpt) >= len(content):
+            continue
+        context[path] = excerpt
+        total -= len(content) - len(excerpt)
+        excerpted.add(path)
+    if excerpted:
+        logger.info("Excerpted %d large files to fit the prompt budget.", len(excerpted))
+    return context, excerpted
+
+_MODIFY_APP_PROMPT = string.Template("""
+As an expert software developer, your task is to modify an existing project named '${task_name}'.
 Apply the following change based on the user's request.
 
-User Request: "{brief}"
+User Request: "${brief}"
 
 The following files are provided as attachments. Your code should be able to use them:
-{attachments}
+${attachments}
 
 The final code must satisfy all of the following evaluation checks:
-{checks}
+${checks}
+
+Here is the current content of the project, as a JSON object mapping file paths to contents:
+${file_contents}
+${excerpt_note}
+First decide which files need to change to fulfill the request, then rewrite them.
+Respond ONLY with a JSON object of the form {"modified_files": {"<file path>": "<complete updated content>"}}.
+Include ONLY the files that need to change. Do not include files that were not modified.
+""")
 
-Here is the current content of the relevant files:
-{existing_files}
+async def _modify_existing_app(task_name: str, brief: str, checks: list, attachments: list, existing_files: dict, on_file=None, warnings: list = None) -> dict:
+    """
+    Modifies an existing application based on a brief, checks, attachments, and file context.
+    The model picks the files to touch and rewrites them in the same call.
+    Problems the caller should report (e.g. dropped rewrites) are appended to warnings.
+    """
+    context_files, excerpted = _build_file_context(existing_files)
+    excerpt_note = ""
+    if excerpted:
+        excerpt_note = (
+            f"These files are too large to show in full and appear only as excerpts: {sorted(excerpted)}\n"
+            "Do NOT return them; their complete content is not available to you.\n"
+        )
+
+    prompt = _MODIFY_APP_PROMPT.substitute(
+        task_name=task_name,
+        brief=brief,
+        attachments=attachments,
+        checks=checks,
+        file_contents=orjson.dumps(context_files).decode('utf-8'),
+        excerpt_note=excerpt_note,
+    )
+
+    forward_file = None
+    if on_file:
+        def forward_file(path, content):
+            if path not in excerpted:
+                on_file(path, content)
+
+    response_dict = await _execute_llm_call(prompt, on_file=forward_file, files_key="modified_files")
+    if "modified_files" not in response_dict:
+        # The model answered with a bare path -> content mapping, or we fell back to an error file.
+        modified_files = response_dict
+    elif isinstance(response_dict["modified_files"], dict):
+        modified_files = response_dict["modified_files"]
+    else:
+        logger.warning("LLM returned a non-object 'modified_files' (%s); treating it as no changes.",
+                       type(response_dict["modified_files"]).__name__)
+        modified_files = {}
+    modified_files = _normalize_files(modified_files)
 
-Respond ONLY with a Python dictionary containing the complete, updated content for ONLY the files that need to change.
-Do not include files that were not modified.
-"""
-    return _execute_llm_call(prompt)
+    # A rewrite built from an excerpt would clobber the real file, so drop it.
+    for path in modified_files.keys() & excerpted:
+        message = f"Ignored rewrite of {path}: the file was too large to show the model in full."
+        logger.warning(message)
+        if warnings is not None:
+            warnings.append(message)
+        del modified_files[path]
+    return modified_files
 
-def generate_app_code(task_name: str, brief: str, checks: list = None, attachments: list = None, existing_files: dict = None) -> dict:
+async def generate_app_code(task_name: str, brief: str, checks: list = None, attachments: list = None, existing_files: dict = None, on_file=None, warnings: list = None) -> dict:
     """
     Main function to generate or modify an application.
     It acts as a dispatcher to the appropriate helper function.
+    on_file, if given, is called with each (path, content) as soon as the model finishes it.
+    warnings, if given, collects problems that should be surfaced in the task result.
     """
     if checks is None:
         checks = []
@@ -133,15 +299,10 @@ def generate_app_code(task_name: str, brief: str, checks: list = None, attachmen
         attachments = []
 
     if existing_files:
-        print(f"Modifying files for brief: '{brief[:50]}...'")
-        all_file_paths = list(existing_files.keys())
-        relevant_file_paths = _llm_filter_relevant_files(brief, all_file_paths)
-        
-        print(f"LLM identified {len(relevant_file_paths)} relevant files out of {len(all_file_paths)} total.")
-        
-        context_files = {path: existing_files[path] for path in relevant_file_paths if path in existing_files}
-        
-        return _modify_existing_app(task_name, brief, checks, attachments, context_files)
+        logger.info("Modifying files for brief: '%s...'", brief[:50])
+        modified_files = await _modify_existing_app(task_name, brief, checks, attachments, existing_files, on_file, warnings)
+        logger.info("LLM modified %d of %d files.", len(modified_files), len(existing_files))
+        return modified_files
     else:
-        print(f"Generating new app for brief: '{brief[:50]}...'")
-        return _generate_new_app(task_name, brief, checks, attachments)
+        logger.info("Generating new app for brief: '%s...'", brief[:50])
+        return await _generate_new_app(task_name, brief, checks, attachments, on_file)
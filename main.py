@@ -4,14 +4,52 @@ from pydantic import BaseModel
 from typing import List, Optional
 import uvicorn
 import asyncio
+import atexit
+import logging
 import os
+import queue
+import secrets
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 
-from handlers import handle_task
+from handlers import handle_task_async, close_github_client
 from dotenv import load_dotenv
 load_dotenv()
 
+# Log records are queued and written to stderr by a listener thread,
+# so logging never blocks the event loop on a stream write.
+_log_queue = queue.SimpleQueue()
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    handlers=[QueueHandler(_log_queue)],
+)
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Tasks still running would fail once the GitHub client is closed; stop them first.
+    for background_task in _background_tasks:
+        background_task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    await close_github_client()
+
+app = FastAPI(lifespan=lifespan)
+
+logger = logging.getLogger(__name__)
+
+# Status of accepted tasks, keyed by task_id. In-process only; lost on restart.
+# Bounded: once TASK_RESULTS_LIMIT is reached the oldest entries are evicted.
+TASK_RESULTS_LIMIT = int(os.getenv("TASK_RESULTS_LIMIT", "1000"))
+task_results = OrderedDict()
+# Strong references so the event loop does not garbage-collect running tasks.
+_background_tasks = set()
 
 class Attachment(BaseModel):
     name: str
@@ -31,20 +69,43 @@ class TaskRequest(BaseModel):
 def home():
     return "working"
 
-@app.post("/api/task")
+async def _run_task(task_id: str, req: TaskRequest, status: dict):
+    # Update the entry directly; it may already have been evicted from task_results.
+    status["status"] = "running"
+    try:
+        result = await handle_task_async(req)
+        status.update(status="done", **result)
+    except asyncio.CancelledError:
+        status["status"] = "cancelled"
+        raise
+    except Exception as e:
+        logger.exception("Task %s failed", task_id)
+        status.update(status="failed", error=str(e))
+
+@app.post("/api/task", status_code=202)
 async def receive_task(req: TaskRequest):
 
     expected_secret = os.getenv("STUDENT_SECRET")
-    print(expected_secret)
-    if req.secret != expected_secret:
+    # Constant-time comparison; an unset secret on our side rejects everything.
+    if not expected_secret or not secrets.compare_digest(req.secret.encode("utf-8"), expected_secret.encode("utf-8")):
         raise HTTPException(status_code=403, detail="Invalid secret")
 
+    task_id = uuid.uuid4().hex
+    status = {"status": "queued", "task": req.task, "round": req.round}
+    task_results[task_id] = status
+    while len(task_results) > TASK_RESULTS_LIMIT:
+        task_results.popitem(last=False)
+    background_task = asyncio.create_task(_run_task(task_id, req, status))
+    _background_tasks.add(background_task)
+    background_task.add_done_callback(_background_tasks.discard)
+    return {"status": "accepted", "task_id": task_id, "message": "Task received and being processed."}
 
-    try:
-        await asyncio.to_thread(handle_task, req)
-        return {"status": "ok", "message": "Task received and being processed."}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+@app.get("/api/task/{task_id}")
+async def task_status(task_id: str):
+    result = task_results.get(task_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Unknown task")
+    return {"task_id": task_id, **result}
 
 
 # if __name__ == "__main__":
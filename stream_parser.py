@@ -0,0 +1,146 @@
+# stream_parser.py
+
+import re
+from json.decoder import scanstring
+
+# The only characters that can end a run of plain string content.
+_STRING_SPECIAL_RE = re.compile(r'["\\]')
+_WHITESPACE = ' \t\r\n'
+_SCALAR_END = ' \t\r\n,:]}'
+
+
+class _Frame:
+    """An open JSON container while the stream is being scanned."""
+    __slots__ = ("kind", "path", "key", "awaiting_value")
+
+    def __init__(self, kind: str, path: tuple):
+        self.kind = kind              # '{' or '['
+        self.path = path              # keys leading to this container; None for array items
+        self.key = None               # last key read in an object
+        self.awaiting_value = False   # a key and ':' have been read, the value hasn't
+
+
+class FileStreamParser:
+    """
+    Incrementally scans a streamed JSON object and reports each "path": "content"
+    member of the files object as soon as its closing quote has arrived.
+    The files object is the top-level object, or the one under files_key.
+    Every character is scanned once; an unfinished string keeps its raw pieces and
+    escape state between chunks and is decoded once, when its closing quote arrives.
+    """
+
+    def __init__(self, files_key: str = None):
+        self._target = () if files_key is None else (files_key,)
+        self._stack = []
+        # Unfinished number/true/false/null carried over to the next chunk (always short).
+        self._pending_scalar = ""
+        # State of a string whose closing quote hasn't arrived yet.
+        self._in_string = False
+        self._string_parts = []
+        self._escape_pending = False
+
+    def feed(self, text: str) -> list:
+        """Consumes the next chunk of the stream and returns the (path, content) pairs it completed."""
+        if self._pending_scalar:
+            text = self._pending_scalar + text
+            self._pending_scalar = ""
+
+        found = []
+        pos = 0
+        while pos < len(text):
+            if self._in_string:
+                pos = self._scan_string(text, pos, found)
+                continue
+            ch = text[pos]
+            if ch in _WHITESPACE or ch == ',':
+                pos += 1
+            elif ch == ':':
+                if self._stack:
+                    self._stack[-1].awaiting_value = True
+                pos += 1
+            elif ch in '{[':
+                self._stack.append(_Frame(ch, self._take_value_path()))
+                pos += 1
+            elif ch in '}]':
+                if self._stack:
+                    self._stack.pop()
+                pos += 1
+            elif ch == '"':
+                self._in_string = True
+                pos += 1
+            else:
+                # Number, true/false/null: only consume it once its terminator is visible.
+                end = pos
+                while end < len(text) and text[end] not in _SCALAR_END:
+                    end += 1
+                if end == len(text):
+                    self._pending_scalar = text[pos:]
+                    break
+                self._take_value_path()
+                pos = end
+        return found
+
+    def _scan_string(self, text: str, pos: int, found: list) -> int:
+        """Advances through string content from pos; returns where scanning should resume."""
+        start = pos
+        if self._escape_pending:
+            # The previous chunk ended on a backslash; this character is escaped.
+            pos += 1
+            self._escape_pending = False
+        while True:
+            match = _STRING_SPECIAL_RE.search(text, pos)
+            if match is None:
+                self._string_parts.append(text[start:])
+                return len(text)
+            i = match.start()
+            if text[i] == '\\':
+                if i + 1 == len(text):
+                    self._escape_pending = True
+                    self._string_parts.append(text[start:])
+                    return len(text)
+                pos = i + 2
+                continue
+            self._string_parts.append(text[start:i])
+            raw = "".join(self._string_parts)
+            self._string_parts = []
+            self._in_string = False
+            try:
+                value = scanstring(raw + '"', 0, False)[0]
+            except ValueError:
+                # Malformed escape; the final full parse decides what to do with it.
+                value = None
+            self._on_string(value, found)
+            return i + 1
+
+    def _take_value_path(self) -> tuple:
+        """Returns the path of the value being read and clears the enclosing object's pending key."""
+        if not self._stack:
+            return ()
+        frame = self._stack[-1]
+        if frame.kind == '[':
+            return frame.path + (None,)
+        key = frame.key
+        frame.key, frame.awaiting_value = None, False
+        return frame.path + (key,)
+
+    def _on_string(self, value, found: list):
+        if not self._stack or self._stack[-1].kind == '[':
+            return
+        frame = self._stack[-1]
+        if not frame.awaiting_value:
+            frame.key = value
+            return
+        if frame.path == self._target and frame.key is not None and value is not None:
+            found.append((frame.key, value))
+        self._take_value_path()
+
+
+def completed_files(reply: dict, files_key: str = None) -> list:
+    """
+    Returns the (path, content) pairs FileStreamParser would have reported for an
+    already parsed reply, e.g. one served from cache: only string members of the files object.
+    """
+    files = reply.get(files_key) if files_key is not None else reply
+    if not isinstance(files, dict):
+        return []
+    return [(path, content) for path, content in files.items() if isinstance(content, str)]
@@ -0,0 +1,101 @@
+import json
+from json.decoder import scanstring
+
+from stream_parser import FileStreamParser, completed_files
+
+
+def _feed_in_chunks(text, size, files_key=None):
+    parser = FileStreamParser(files_key)
+    found = []
+    for i in range(0, len(text), size):
+        found += parser.feed(text[i:i + size])
+    return found
+
+
+def _feed_split_at(text, split, files_key=None):
+    parser = FileStreamParser(files_key)
+    return parser.feed(text[:split]) + parser.feed(text[split:])
+
+
+def test_top_level_files_reported_in_order():
+    doc = json.dumps({"index.html": "<p>hi</p>", "app.js": "x = 1;"})
+    assert _feed_in_chunks(doc, 3) == [("index.html", "<p>hi</p>"), ("app.js", "x = 1;")]
+
+
+def test_every_split_point_of_escapes_unicode_and_surrogates():
+    content = 'say \\"hi\\" \\\\ \u00e9 \ud83d\ude00 <a href=\\"/x\\">'
+    raw = '{"a.html": "' + content + '", "b.css": "p{}"}'
+    expected = [("a.html", json.loads('"' + content + '"')), ("b.css", "p{}")]
+    for split in range(len(raw) + 1):
+        assert _feed_split_at(raw, split) == expected, split
+
+
+def test_escaped_unicode_split_inside_escape_sequences():
+    raw = '{"f.txt": "\\u00e9\\ud83d\\ude00\\""}'
+    expected = [("f.txt", "\u00e9\U0001F600\"")]
+    for size in range(1, len(raw) + 1):
+        assert _feed_in_chunks(raw, size) == expected, size
+
+
+def test_only_string_members_of_modified_files_are_reported():
+    doc = json.dumps({
+        "note": "ignored",
+        "modified_files": {
+            "a.css": "b{}",
+            "manifest.json": {"name": "nested", "icons": ["x.png"]},
+            "list": ["not", {"a": "file"}],
+            "n": 5,
+            "c.js": "last",
+        },
+        "tail": "ignored",
+    }, indent=2)
+    for size in (1, 2, 5, 17):
+        assert _feed_in_chunks(doc, size, "modified_files") == [("a.css", "b{}"), ("c.js", "last")]
+
+
+def test_scalars_split_across_chunks():
+    raw = '{"n": 12345, "t": true, "f.txt": "ok", "z": null}'
+    for size in range(1, 6):
+        assert _feed_in_chunks(raw, size) == [("f.txt", "ok")]
+
+
+def test_long_escaped_string_is_scanned_and_decoded_once(monkeypatch):
+    import stream_parser
+
+    scanned = []
+    decoded = []
+
+    class CountingRegex:
+        def __init__(self, regex):
+            self._regex = regex
+
+        def search(self, text, pos):
+            match = self._regex.search(text, pos)
+            scanned.append((match.end() if match else len(text)) - pos)
+            return match
+
+    def counting_scanstring(s, end, strict):
+        decoded.append(len(s) - end)
+        return scanstring(s, end, strict)
+
+    monkeypatch.setattr(stream_parser, "_STRING_SPECIAL_RE", CountingRegex(stream_parser._STRING_SPECIAL_RE))
+    monkeypatch.setattr(stream_parser, "scanstring", counting_scanstring)
+
+    content = '<div class=\\"row\\">x</div>' * 8000
+    raw = '{"index.html": "' + content + '"}'
+    found = _feed_in_chunks(raw, 4)
+    assert found == [("index.html", json.loads('"' + content + '"'))]
+    # Each character of the string is searched at most once, and the string is decoded exactly once.
+    assert sum(scanned) <= len(raw)
+    assert decoded == [len("index.html") + 1, len(content) + 1]
+
+
+def test_cache_replay_matches_what_the_stream_reports():
+    replies = [
+        ({"modified_files": {"manifest.json": {"a": 1}, "a.js": "x", "n": None, "l": [1]}}, "modified_files"),
+        ({"modified_files": []}, "modified_files"),
+        ({"index.html": "<p>", "count": 3, "nested": {"k": "v"}}, None),
+    ]
+    for reply, files_key in replies:
+        streamed = _feed_in_chunks(json.dumps(reply), 3, files_key)
+        assert completed_files(reply, files_key) == streamed